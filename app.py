@@ -1,9 +1,24 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_file, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from sqlalchemy import event, create_engine, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.dialects import postgresql, sqlite
+import click
+from datetime import datetime, timedelta
+from collections import Counter
 import os
 import csv
 import io
+import json
+import secrets
+import threading
+import time
+import cProfile
+import pstats
+import random
+import uuid
+import sqlite3
 from dotenv import load_dotenv
 import requests
 import asyncio
@@ -30,30 +45,968 @@ db = SQLAlchemy(app)
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
 
+# Inventory event stream configuration; turn off where responses are buffered (Netlify)
+LIVE_UPDATES = os.getenv('LIVE_UPDATES', '1').lower() not in ('0', 'false', 'no')
+EVENT_POLL_INTERVAL = float(os.getenv('EVENT_POLL_INTERVAL', '2'))
+EVENT_STREAM_MAX_SECONDS = int(os.getenv('EVENT_STREAM_MAX_SECONDS', '300'))
+EVENT_LOG_SIZE = int(os.getenv('EVENT_LOG_SIZE', '1000'))
+EVENT_IMPORT_INLINE_LIMIT = int(os.getenv('EVENT_IMPORT_INLINE_LIMIT', '200'))
+# Each open stream holds a worker thread; clients past the cap get 204 and fall back to reloading
+EVENT_STREAMS_PER_WORKER = int(os.getenv('EVENT_STREAMS_PER_WORKER', '4'))
+
+# Claim lease configuration
+LEASE_SECONDS = int(os.getenv('LEASE_SECONDS', '300'))
+LEASE_SWEEP_INTERVAL = int(os.getenv('LEASE_SWEEP_INTERVAL', '30'))
+LEASE_SWEEP_BATCH = int(os.getenv('LEASE_SWEEP_BATCH', '100'))
+
+# Request profiling configuration
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_EXPLAIN = os.getenv('PROFILE_EXPLAIN', '').lower() in ('1', 'true', 'yes')
+PROFILE_TOP_FUNCTIONS = int(os.getenv('PROFILE_TOP_FUNCTIONS', '30'))
+PROFILE_RETENTION_DAYS = int(os.getenv('PROFILE_RETENTION_DAYS', '7'))
+
+# Admin operations (bulk replacement) require this token in X-Admin-Token
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+BULK_REPLACEMENT_CHUNK = int(os.getenv('BULK_REPLACEMENT_CHUNK', '500'))
+
+# Replacement chains longer than this (or cycles) are cut off in either direction
+HISTORY_MAX_DEPTH = int(os.getenv('HISTORY_MAX_DEPTH', '100'))
+
+# Inventory sharding configuration: a JSON object mapping shard numbers to a
+# database URL and the services stored there, e.g.
+# {"1": {"url": "sqlite:///netflix.db", "services": ["Netflix"]}}
+# Services not listed stay in the main database, which is shard 0.
+INVENTORY_SHARDS = json.loads(os.getenv('INVENTORY_SHARDS') or '{}')
+# Accounts created in shard N get ids above N * SHARD_ID_SPAN, keeping ids
+# unique. Shard numbers must start ranges within a 32-bit integer column.
+SHARD_ID_SPAN = 10 ** 8
+MAX_SHARD = (2 ** 31 - 1) // SHARD_ID_SPAN
+
+def check_inventory_shards(shards):
+    """Reject an INVENTORY_SHARDS setting that would mix up account ids."""
+    services = set()
+    for shard, config in shards.items():
+        if not shard.isdigit() or not 1 <= int(shard) <= MAX_SHARD:
+            # Shard 0 is the main database; higher numbers overflow account.id
+            raise ValueError(f"INVENTORY_SHARDS: shard {shard!r} must be a number from 1 to {MAX_SHARD}")
+        duplicated = services.intersection(config['services'])
+        if duplicated:
+            raise ValueError(f"INVENTORY_SHARDS: {', '.join(sorted(duplicated))} listed in more than one shard")
+        services.update(config['services'])
+
+check_inventory_shards(INVENTORY_SHARDS)
+
 class Account(db.Model):
+    # Stock counts per service after every inventory change read only this index
+    __table_args__ = (db.Index('ix_account_service_available', 'service', 'is_available'),)
+
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), nullable=False)
     password = db.Column(db.String(120), nullable=False)
     service = db.Column(db.String(50), nullable=False)
     verification_code = db.Column(db.String(20))
     is_available = db.Column(db.Boolean, default=True)
+    # Shared by every account created by one CSV import
+    import_batch = db.Column(db.String(32), index=True)
+    # Pulled from stock by a bulk replacement without ever being handed out
+    retired_at = db.Column(db.DateTime)
+    # Set while a claim is unconfirmed; the token stays after confirmation
+    lease_token = db.Column(db.String(64))
+    lease_expires_at = db.Column(db.DateTime, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    @property
+    def lease_status(self):
+        if self.is_available:
+            return 'available'
+        if self.retired_at is not None:
+            return 'retired'
+        if self.lease_expires_at is not None:
+            return 'leased'
+        return 'confirmed'
+
+def account_foreign_key():
+    # Sharded accounts live in other databases, which a foreign key cannot reference
+    return () if INVENTORY_SHARDS else (db.ForeignKey('account.id'),)
+
 class Issue(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
+    account_id = db.Column(db.Integer, *account_foreign_key(), nullable=False, index=True)
     issue_type = db.Column(db.String(50), nullable=False)
     description = db.Column(db.Text)
     status = db.Column(db.String(20), default='pending')
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
 class Replacement(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    old_account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
-    new_account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
+    old_account_id = db.Column(db.Integer, *account_foreign_key(), nullable=False, index=True)
+    new_account_id = db.Column(db.Integer, *account_foreign_key(), nullable=False, index=True)
     reason = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class StatsRollup(db.Model):
+    # One row per bucket, kind, service and issue_type; replacements use issue_type ''.
+    # The key leads with (granularity, bucket_start) so it also serves range reads.
+    granularity = db.Column(db.String(10), primary_key=True)
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    kind = db.Column(db.String(20), primary_key=True)
+    service = db.Column(db.String(50), primary_key=True)
+    issue_type = db.Column(db.String(50), primary_key=True, default='')
+    event_count = db.Column(db.Integer, nullable=False, default=0)
+
+class InventoryEvent(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    event_type = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class RequestProfile(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    method = db.Column(db.String(10), nullable=False)
+    path = db.Column(db.String(255), nullable=False)
+    status_code = db.Column(db.Integer)
+    duration_ms = db.Column(db.Float)
+    statement_count = db.Column(db.Integer)
+    sql_ms = db.Column(db.Float)
+    report = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+shard_engines = {int(shard): create_engine(config['url']) for shard, config in INVENTORY_SHARDS.items()}
+shard_sessions = {shard: scoped_session(sessionmaker(bind=engine)) for shard, engine in shard_engines.items()}
+service_shards = {service: int(shard) for shard, config in INVENTORY_SHARDS.items() for service in config['services']}
+
+def inventory_shards():
+    return [0] + sorted(shard_engines)
+
+def shard_session(shard):
+    return db.session if shard == 0 else shard_sessions[shard]
+
+def shard_dialect(shard):
+    return (db.engine if shard == 0 else shard_engines[shard]).dialect.name
+
+def shard_for_service(service):
+    return service_shards.get(service, 0)
+
+def account_shards(account_id):
+    """Shards that may hold an account, the one its id was allocated in first."""
+    home = account_id // SHARD_ID_SPAN
+    return sorted(inventory_shards(), key=lambda shard: shard != home)
+
+def get_account(account_id):
+    """Find an account in whichever shard holds it; returns (account, session)."""
+    try:
+        account_id = int(account_id)
+    except (TypeError, ValueError):
+        return None, None
+    for shard in account_shards(account_id):
+        session = shard_session(shard)
+        account = session.query(Account).get(account_id)
+        if account:
+            return account, session
+    return None, None
+
+def load_accounts(account_ids):
+    """Fetch accounts by id with one query per shard involved.
+
+    Ids are looked up in the shard that allocated them first; only ids
+    not found there (accounts moved in from the main database) are looked
+    for in the other shards.
+    """
+    found = {}
+    for in_home_shard in (True, False):
+        for shard in inventory_shards():
+            ids = [account_id for account_id in account_ids if account_id not in found
+                   and (account_id // SHARD_ID_SPAN == shard) == in_home_shard]
+            if ids:
+                for account in shard_session(shard).query(Account).filter(Account.id.in_(ids)).all():
+                    found[account.id] = account
+    return list(found.values())
+
+def available_accounts():
+    # Fans out to every shard; results are merged in shard order
+    return [account for shard in inventory_shards()
+            for account in shard_session(shard).query(Account).filter_by(is_available=True).all()]
+
+def commit_inventory(*sessions, handed_out=None):
+    """Commit the shard sessions a write touched, then the main session.
+
+    Shards are separate databases, so this is not atomic. Inventory is
+    committed first: the main database never records a claim or
+    replacement whose account change was rolled back.
+
+    `handed_out` maps shard sessions to the ids of accounts the main
+    session records as replacements. Those are committed under a lease
+    that is only cleared once the main commit succeeded, so if it fails
+    the sweeper returns them to stock rather than leaving them out of
+    stock with no replacement pointing at them.
+    """
+    leased = {session: account_ids for session, account_ids in (handed_out or {}).items()
+              if session is not db.session}
+    if leased:
+        lease_token = secrets.token_urlsafe(24)
+        lease_expires_at = datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)
+        for session, account_ids in leased.items():
+            session.execute(Account.__table__.update().where(Account.id.in_(account_ids)).values(
+                lease_token=lease_token, lease_expires_at=lease_expires_at
+            ))
+    for session in dict.fromkeys(sessions):
+        if session is not db.session:
+            session.commit()
+    db.session.commit()
+    for session, account_ids in leased.items():
+        session.execute(Account.__table__.update().where(
+            Account.id.in_(account_ids),
+            Account.lease_token == lease_token
+        ).values(lease_token=None, lease_expires_at=None))
+        session.commit()
+
+@app.teardown_appcontext
+def remove_shard_sessions(exc):
+    for session in shard_sessions.values():
+        session.remove()
+
+def upgrade_schema(engine, tables):
+    """Add the columns and indexes that create_all() skips on existing tables.
+
+    Only what is missing is added, so this is safe to run on every start.
+    Added columns are nullable and existing rows keep NULL in them.
+    """
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    connection.execute(db.text(
+                        f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN "
+                        f"{preparer.format_column(column)} {column.type.compile(dialect=engine.dialect)}"
+                    ))
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+def drop_account_foreign_keys():
+    """Drop foreign keys to account created before sharding was turned on."""
+    if db.engine.dialect.name == 'sqlite':
+        # Not enforced unless PRAGMA foreign_keys is on, and SQLite cannot drop them
+        return
+    preparer = db.engine.dialect.identifier_preparer
+    with db.engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in (Issue.__table__, Replacement.__table__):
+            if not inspector.has_table(table.name):
+                continue
+            for foreign_key in inspector.get_foreign_keys(table.name):
+                if foreign_key['referred_table'] == 'account' and foreign_key['name']:
+                    connection.execute(db.text(
+                        f"ALTER TABLE {preparer.format_table(table)} "
+                        f"DROP CONSTRAINT {preparer.quote(foreign_key['name'])}"
+                    ))
+
+def init_inventory_shards():
+    """Create the account and event tables in each shard, allocating account ids from the shard's range."""
+    if shard_engines:
+        drop_account_foreign_keys()
+    for shard, engine in shard_engines.items():
+        metadata = db.MetaData()
+        table = Account.__table__.to_metadata(metadata)
+        # AUTOINCREMENT makes SQLite keep allocating above the seeded start
+        table.dialect_options['sqlite']['autoincrement'] = True
+        events = InventoryEvent.__table__.to_metadata(metadata)
+        metadata.create_all(engine)
+        upgrade_schema(engine, [table, events])
+        start = shard * SHARD_ID_SPAN
+        with engine.begin() as connection:
+            if engine.dialect.name == 'sqlite':
+                connection.execute(db.text(
+                    "INSERT INTO sqlite_sequence (name, seq) SELECT 'account', :start "
+                    "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'account')"
+                ), {'start': start})
+            elif engine.dialect.name == 'postgresql':
+                connection.execute(db.text(
+                    "SELECT setval(pg_get_serial_sequence('account', 'id'), "
+                    "GREATEST(:start, (SELECT COALESCE(MAX(id), 0) FROM account)))"
+                ), {'start': start})
+            else:
+                raise ValueError(f"Inventory shard {shard} must be a SQLite or PostgreSQL database")
+
+def serialize_account(account):
+    return {
+        'id': account.id,
+        'email': account.email,
+        'password': account.password,
+        'service': account.service,
+        'verification_code': account.verification_code
+    }
+
+def stock_counts(services):
+    counts = {service: 0 for service in services}
+    by_shard = {}
+    for service in services:
+        by_shard.setdefault(shard_for_service(service), []).append(service)
+    for shard, shard_services in by_shard.items():
+        query = shard_session(shard).query(Account.service, db.func.count(Account.id)).filter(
+            Account.is_available == True,
+            Account.service.in_(shard_services)
+        )
+        counts.update(dict(query.group_by(Account.service).all()))
+    return counts
+
+# Wakes event streams in this process as soon as a write commits; streams
+# served by other workers pick the change up on their next poll.
+inventory_changed = threading.Condition()
+# Advisory lock serialising event inserts on PostgreSQL (arbitrary app-wide key)
+EVENT_SEQUENCE_LOCK = 0x696E76
+event_stream_slots = threading.BoundedSemaphore(EVENT_STREAMS_PER_WORKER)
+
+def limit_event_streams(limit):
+    """Change how many streams this process serves at once."""
+    global event_stream_slots
+    event_stream_slots = threading.BoundedSemaphore(limit)
+
+def publish_inventory_event(shard, event_type, payload, services):
+    """Record an inventory delta in the current transaction of a shard.
+
+    The event row is committed together with the change it describes, so
+    listeners never see an event for a write that was rolled back. Each
+    shard keeps its own log, so inventory writes to a shard never wait
+    on the main database.
+    Streams read events by id, so ids must become visible in order: on
+    PostgreSQL an advisory lock held until commit keeps a later id from
+    committing before an earlier one. SQLite only has one writer anyway.
+    """
+    session = shard_session(shard)
+    if shard_dialect(shard) == 'postgresql':
+        session.execute(db.text('SELECT pg_advisory_xact_lock(:key)'), {'key': EVENT_SEQUENCE_LOCK})
+    payload = dict(payload, stock=stock_counts(services))
+    inventory_event = InventoryEvent(event_type=event_type, payload=json.dumps(payload))
+    session.add(inventory_event)
+    session.flush()
+    # Keep the log bounded; reconnecting clients only need recent deltas
+    session.query(InventoryEvent).filter(
+        InventoryEvent.id <= inventory_event.id - EVENT_LOG_SIZE
+    ).delete(synchronize_session=False)
+    session.info['inventory_changed'] = True
+
+def notify_inventory_listeners(session):
+    if session.info.pop('inventory_changed', False):
+        with inventory_changed:
+            inventory_changed.notify_all()
+
+for inventory_session in [db.session, *shard_sessions.values()]:
+    event.listen(inventory_session, 'after_commit', notify_inventory_listeners)
+
+def serialize_lease(account):
+    return {
+        'status': account.lease_status,
+        'token': account.lease_token,
+        'expires_at': account.lease_expires_at.isoformat() + 'Z' if account.lease_expires_at else None
+    }
+
+def recycle_expired_leases(batch_size=LEASE_SWEEP_BATCH):
+    """Return accounts whose lease ran out to stock, one small batch per transaction."""
+    released = 0
+    for shard in inventory_shards():
+        session = shard_session(shard)
+        while True:
+            now = datetime.utcnow()
+            # Walks the lease_expires_at index; rows a confirm is holding are left for the next pass
+            accounts = session.query(Account).filter(
+                Account.lease_expires_at <= now
+            ).order_by(Account.lease_expires_at).limit(batch_size).with_for_update(skip_locked=True).all()
+            if not accounts:
+                session.rollback()
+                break
+            account_ids = [account.id for account in accounts]
+            kept_ids = keep_recorded_replacements(session, account_ids, now)
+            released_ids = release_expired_leases(
+                session, shard, [account_id for account_id in account_ids if account_id not in kept_ids], now
+            )
+            accounts_released = [account for account in accounts if account.id in released_ids]
+            if accounts_released:
+                publish_inventory_event(
+                    shard,
+                    'accounts_released',
+                    {'accounts': [serialize_account(account) for account in accounts_released]},
+                    {account.service for account in accounts_released}
+                )
+                commit_inventory(session)
+            elif kept_ids:
+                session.commit()
+            else:
+                session.rollback()
+            released += len(accounts_released)
+            if len(accounts) < batch_size:
+                break
+    return released
+
+def keep_recorded_replacements(session, account_ids, now):
+    """Clear expired leases on shard accounts the main database records as replacements.
+
+    commit_inventory() leases replacement stock until the main commit has
+    succeeded. If the process stopped before it cleared the lease, the
+    replacement still stands and the account must not go back to stock.
+    Returns the ids kept out of stock.
+    """
+    if session is db.session:
+        return set()
+    kept_ids = {account_id for (account_id,) in db.session.query(Replacement.new_account_id).filter(
+        Replacement.new_account_id.in_(account_ids)
+    )}
+    if kept_ids:
+        session.execute(Account.__table__.update().where(
+            Account.id.in_(kept_ids),
+            Account.lease_expires_at <= now
+        ).values(lease_token=None, lease_expires_at=None))
+    return kept_ids
+
+def release_expired_leases(session, shard, account_ids, now):
+    """Put accounts back in stock if their lease is still expired; returns the ids released.
+
+    The expiry is checked again in the UPDATE. A replacement or confirm may
+    have cleared the lease since the rows were selected, and on SQLite,
+    where FOR UPDATE SKIP LOCKED does nothing, every worker's sweeper
+    selects the same rows.
+    """
+    release = Account.__table__.update().where(
+        Account.id.in_(account_ids),
+        Account.lease_expires_at <= now
+    ).values(is_available=True, lease_token=None, lease_expires_at=None)
+    if shard_dialect(shard) == 'postgresql':
+        return {account_id for (account_id,) in session.execute(release.returning(Account.id))}
+    result = session.execute(release)
+    if result.rowcount == len(account_ids):
+        return set(account_ids)
+    if result.rowcount == 0:
+        return set()
+    # Some rows changed since the select; the write lock is ours now, so read back which are in stock
+    return {account_id for (account_id,) in session.query(Account.id).filter(
+        Account.id.in_(account_ids),
+        Account.is_available == True
+    )}
+
+def start_lease_sweeper():
+    """Run the expiry sweep in a daemon thread of the current process."""
+    def sweep():
+        while True:
+            time.sleep(LEASE_SWEEP_INTERVAL)
+            with app.app_context():
+                try:
+                    recycle_expired_leases()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error recycling expired leases: {e}")
+
+    thread = threading.Thread(target=sweep, name='lease-sweeper', daemon=True)
+    thread.start()
+    return thread
+
+# Per-thread state of the request being profiled; None for every other request
+profiling = threading.local()
+
+def profile_authorized():
+    token = request.headers.get('X-Profile')
+    return bool(token and PROFILE_TOKEN and secrets.compare_digest(token, PROFILE_TOKEN))
+
+@app.before_request
+def start_request_profile():
+    profiling.state = None
+    # Fast path: nothing to do unless asked for or sampling is on
+    if 'X-Profile' not in request.headers and not PROFILE_SAMPLE_RATE:
+        return
+    if request.endpoint == 'get_request_profile':
+        return
+    authorized = profile_authorized()
+    if not authorized and random.random() >= PROFILE_SAMPLE_RATE:
+        return
+    profiler = cProfile.Profile()
+    profiling.state = {
+        'id': uuid.uuid4().hex,
+        'explain': PROFILE_EXPLAIN or (authorized and request.headers.get('X-Profile-Explain') == '1'),
+        'statements': [],
+        'profiler': profiler,
+        'started': time.perf_counter()
+    }
+    profiler.enable()
+
+@app.after_request
+def finish_request_profile(response):
+    state = getattr(profiling, 'state', None)
+    if state is None:
+        return response
+    # Stop capturing before the report is written so its own INSERT is not recorded
+    profiling.state = None
+    state['profiler'].disable()
+    duration_ms = (time.perf_counter() - state['started']) * 1000
+    sql_ms = sum(statement['duration_ms'] for statement in state['statements'])
+
+    stats_output = io.StringIO()
+    pstats.Stats(state['profiler'], stream=stats_output).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    report = {
+        'id': state['id'],
+        'method': request.method,
+        'path': request.path,
+        'status_code': response.status_code,
+        'duration_ms': round(duration_ms, 3),
+        'sql': {
+            'count': len(state['statements']),
+            'duration_ms': round(sql_ms, 3),
+            'statements': state['statements']
+        },
+        'functions': stats_output.getvalue()
+    }
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(RequestProfile.__table__.insert().values(
+                id=state['id'],
+                method=request.method,
+                path=request.path[:255],
+                status_code=response.status_code,
+                duration_ms=report['duration_ms'],
+                statement_count=len(state['statements']),
+                sql_ms=report['sql']['duration_ms'],
+                report=json.dumps(report),
+                created_at=datetime.utcnow()
+            ))
+            connection.execute(RequestProfile.__table__.delete().where(
+                RequestProfile.created_at < datetime.utcnow() - timedelta(days=PROFILE_RETENTION_DAYS)
+            ))
+    except Exception as e:
+        print(f"Error storing request profile: {e}")
+
+    response.headers['X-Profile-Id'] = state['id']
+    response.headers['Server-Timing'] = f'app;dur={duration_ms:.1f}, sql;dur={sql_ms:.1f};desc="{len(state["statements"])} statements"'
+    return response
+
+@app.teardown_request
+def discard_request_profile(exc):
+    # Requests that raised never reach after_request
+    state = getattr(profiling, 'state', None)
+    if state is not None:
+        state['profiler'].disable()
+        profiling.state = None
+
+def explain_statement(connection, statement, parameters):
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.dialect.name == 'sqlite' else 'EXPLAIN '
+    # A raw DBAPI cursor keeps the EXPLAIN itself out of the capture
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return [' | '.join(str(column) for column in row) for row in cursor.fetchall()]
+    except Exception as e:
+        return [f'EXPLAIN failed: {e}']
+    finally:
+        cursor.close()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if getattr(profiling, 'state', None) is not None:
+        connection.info.setdefault('profile_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    started = connection.info.get('profile_started')
+    if not started:
+        return
+    duration_ms = (time.perf_counter() - started.pop()) * 1000
+    state = getattr(profiling, 'state', None)
+    if state is None:
+        return
+    captured = {
+        'statement': statement,
+        'parameters': repr(parameters)[:500],
+        'duration_ms': round(duration_ms, 3),
+        'executemany': executemany
+    }
+    if state['explain'] and not executemany and statement.lstrip().upper().startswith('SELECT'):
+        captured['plan'] = explain_statement(connection, statement, parameters)
+    state['statements'].append(captured)
+
+STATS_GRANULARITIES = ('hour', 'day')
+
+def bucket_start(moment, granularity):
+    if granularity == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def bump_stats(kind, service, occurred_at, issue_type='', count=1):
+    """Count issues or replacements in their hourly and daily buckets.
+
+    Runs in the caller's transaction as a single upsert, so the rollups
+    never disagree with the rows they summarise.
+    """
+    rows = [{
+        'kind': kind,
+        'granularity': granularity,
+        'bucket_start': bucket_start(occurred_at, granularity),
+        'service': service,
+        'issue_type': issue_type or '',
+        'event_count': count
+    } for granularity in STATS_GRANULARITIES]
+    table = StatsRollup.__table__
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = (postgresql if dialect == 'postgresql' else sqlite).insert(table).values(rows)
+        db.session.execute(insert.on_conflict_do_update(
+            index_elements=[column.name for column in table.primary_key],
+            set_={'event_count': table.c.event_count + insert.excluded.event_count}
+        ))
+        return
+    for row in rows:
+        updated = db.session.execute(table.update().where(db.and_(
+            *(column == row[column.name] for column in table.primary_key)
+        )).values(event_count=table.c.event_count + row['event_count']))
+        if not updated.rowcount:
+            db.session.execute(table.insert().values(row))
+
+def rebuild_stats(since):
+    """Recompute every rollup bucket from `since` onwards out of Issue and Replacement.
+
+    Used to backfill history and to repair buckets after manual edits.
+    Scans only the requested range through the created_at indexes.
+    """
+    since = bucket_start(since, 'day')
+    counts = Counter()
+    # Rows whose account lives in another shard; their service is looked up afterwards
+    unresolved = []
+
+    def count(kind, created_at, service, issue_type):
+        for granularity in STATS_GRANULARITIES:
+            counts[(kind, granularity, bucket_start(created_at, granularity), service, issue_type or '')] += 1
+
+    issues = db.session.query(Issue.created_at, Issue.account_id, Account.service, Issue.issue_type).outerjoin(
+        Account, Issue.account_id == Account.id
+    ).filter(Issue.created_at >= since).yield_per(1000)
+    for created_at, account_id, service, issue_type in issues:
+        if service is None:
+            unresolved.append(('issue', created_at, account_id, issue_type))
+        else:
+            count('issue', created_at, service, issue_type)
+    replacements = db.session.query(Replacement.created_at, Replacement.old_account_id, Account.service).outerjoin(
+        Account, Replacement.old_account_id == Account.id
+    ).filter(Replacement.created_at >= since).yield_per(1000)
+    for created_at, account_id, service in replacements:
+        if service is None:
+            unresolved.append(('replacement', created_at, account_id, ''))
+        else:
+            count('replacement', created_at, service, '')
+
+    for start in range(0, len(unresolved), 1000):
+        batch = unresolved[start:start + 1000]
+        services = {account.id: account.service for account in load_accounts({row[2] for row in batch})}
+        for kind, created_at, account_id, issue_type in batch:
+            if account_id in services:
+                count(kind, created_at, services[account_id], issue_type)
+
+    StatsRollup.query.filter(StatsRollup.bucket_start >= since).delete(synchronize_session=False)
+    if counts:
+        db.session.execute(StatsRollup.__table__.insert(), [{
+            'kind': kind,
+            'granularity': granularity,
+            'bucket_start': bucket,
+            'service': service,
+            'issue_type': issue_type,
+            'event_count': event_count
+        } for (kind, granularity, bucket, service, issue_type), event_count in counts.items()])
+    db.session.commit()
+    return len(counts)
+
+# Walks the replacement graph backwards and forwards from one account and
+# joins each account in the chain to its issues, in a single round trip.
+# Accounts kept in other shards come back without details and are loaded separately.
+ACCOUNT_HISTORY_SQL = db.text("""
+    WITH RECURSIVE forward(account_id, depth, replacement_id) AS (
+        SELECT CAST(:account_id AS INTEGER), 0, CAST(NULL AS INTEGER)
+        UNION
+        SELECT r.new_account_id, f.depth + 1, r.id
+        FROM replacement r JOIN forward f ON r.old_account_id = f.account_id
+        WHERE f.depth < :max_depth
+    ),
+    backward(account_id, depth, replacement_id) AS (
+        SELECT CAST(:account_id AS INTEGER), 0, CAST(NULL AS INTEGER)
+        UNION
+        SELECT r.old_account_id, b.depth - 1, r.id
+        FROM replacement r JOIN backward b ON r.new_account_id = b.account_id
+        WHERE b.depth > :min_depth
+    ),
+    chain AS (
+        SELECT account_id, depth, replacement_id FROM forward
+        UNION
+        SELECT account_id, depth, replacement_id FROM backward
+    )
+    SELECT chain.depth, chain.account_id, a.id AS found_account_id, a.email, a.password, a.service,
+           a.verification_code, a.is_available, a.created_at AS account_created_at,
+           r.id AS replacement_id, r.old_account_id, r.new_account_id, r.reason,
+           r.created_at AS replaced_at,
+           i.id AS issue_id, i.issue_type, i.description, i.status,
+           i.created_at AS issue_created_at
+    FROM chain
+    LEFT JOIN account a ON a.id = chain.account_id
+    LEFT JOIN replacement r ON r.id = chain.replacement_id
+    LEFT JOIN issue i ON i.account_id = chain.account_id
+""").columns(
+    depth=db.Integer, account_id=db.Integer, found_account_id=db.Integer, is_available=db.Boolean,
+    account_created_at=db.DateTime, replacement_id=db.Integer, replaced_at=db.DateTime,
+    issue_id=db.Integer, issue_created_at=db.DateTime
+)
+
+def supports_recursive_cte():
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 8, 3)
+    return dialect == 'postgresql'
+
+def closer_to_origin(depth, current):
+    # An account reachable at several depths is reported at the shortest one, later ones first
+    return current is None or (abs(depth), depth) < (abs(current), current)
+
+def format_timestamp(moment):
+    return moment.isoformat() + 'Z' if moment else None
+
+def history_account(account):
+    return {
+        'id': account.id,
+        'email': account.email,
+        'password': account.password,
+        'service': account.service,
+        'verification_code': account.verification_code,
+        'is_available': account.is_available,
+        'created_at': format_timestamp(account.created_at)
+    }
+
+def build_account_history(account_id, depths, accounts, issues, replacements):
+    if account_id not in accounts:
+        return None
+    for account in accounts.values():
+        account['depth'] = depths[account['id']]
+        account['issues'] = sorted(
+            (issue for issue in issues.values() if issue['account_id'] == account['id']),
+            key=lambda issue: (issue['created_at'] or '', issue['id'])
+        )
+    return {
+        'account_id': account_id,
+        'accounts': sorted(accounts.values(), key=lambda account: (account['depth'], account['id'])),
+        'replacements': sorted(replacements.values(), key=lambda hop: (hop['created_at'] or '', hop['id']))
+    }
+
+def account_history_recursive(account_id):
+    depths, accounts, issues, replacements = {}, {}, {}, {}
+    rows = db.session.execute(ACCOUNT_HISTORY_SQL, {
+        'account_id': account_id,
+        'max_depth': HISTORY_MAX_DEPTH,
+        'min_depth': -HISTORY_MAX_DEPTH
+    }).mappings()
+    for row in rows:
+        if closer_to_origin(row['depth'], depths.get(row['account_id'])):
+            depths[row['account_id']] = row['depth']
+        if row['found_account_id'] is not None:
+            accounts[row['account_id']] = {
+                'id': row['account_id'],
+                'email': row['email'],
+                'password': row['password'],
+                'service': row['service'],
+                'verification_code': row['verification_code'],
+                'is_available': row['is_available'],
+                'created_at': format_timestamp(row['account_created_at'])
+            }
+        if row['replacement_id'] is not None:
+            replacements[row['replacement_id']] = {
+                'id': row['replacement_id'],
+                'old_account_id': row['old_account_id'],
+                'new_account_id': row['new_account_id'],
+                'reason': row['reason'],
+                'created_at': format_timestamp(row['replaced_at'])
+            }
+        if row['issue_id'] is not None:
+            issues[row['issue_id']] = {
+                'id': row['issue_id'],
+                'account_id': row['account_id'],
+                'issue_type': row['issue_type'],
+                'description': row['description'],
+                'status': row['status'],
+                'created_at': format_timestamp(row['issue_created_at'])
+            }
+    missing = depths.keys() - accounts.keys()
+    if missing:
+        accounts.update((account.id, history_account(account)) for account in load_accounts(missing))
+    depths = {chained_id: depth for chained_id, depth in depths.items() if chained_id in accounts}
+    return build_account_history(account_id, depths, accounts, issues, replacements)
+
+def account_history_iterative(account_id):
+    """Same result as account_history_recursive, one query per hop.
+
+    Used where the database has no recursive CTEs.
+    """
+    depths, replacements = {account_id: 0}, {}
+    for step in (1, -1):
+        visited, frontier, depth = {account_id}, [account_id], 0
+        while frontier and abs(depth) < HISTORY_MAX_DEPTH:
+            if step > 0:
+                hops = Replacement.query.filter(Replacement.old_account_id.in_(frontier)).all()
+            else:
+                hops = Replacement.query.filter(Replacement.new_account_id.in_(frontier)).all()
+            depth += step
+            frontier = []
+            for hop in hops:
+                replacements[hop.id] = {
+                    'id': hop.id,
+                    'old_account_id': hop.old_account_id,
+                    'new_account_id': hop.new_account_id,
+                    'reason': hop.reason,
+                    'created_at': format_timestamp(hop.created_at)
+                }
+                reached = hop.new_account_id if step > 0 else hop.old_account_id
+                if closer_to_origin(depth, depths.get(reached)):
+                    depths[reached] = depth
+                if reached not in visited:
+                    visited.add(reached)
+                    frontier.append(reached)
+
+    accounts = {account.id: history_account(account) for account in load_accounts(depths)}
+    issues = {issue.id: {
+        'id': issue.id,
+        'account_id': issue.account_id,
+        'issue_type': issue.issue_type,
+        'description': issue.description,
+        'status': issue.status,
+        'created_at': format_timestamp(issue.created_at)
+    } for issue in Issue.query.filter(Issue.account_id.in_(depths)).all()}
+    return build_account_history(account_id, depths, accounts, issues, replacements)
+
+def admin_authorized():
+    token = request.headers.get('X-Admin-Token')
+    return bool(token and ADMIN_TOKEN and secrets.compare_digest(token, ADMIN_TOKEN))
+
+def replace_accounts_in_bulk(affected, reason, stock_filter=None):
+    """Pair affected accounts with fresh stock of the same service.
+
+    `affected` is a list of (account_id, service). `stock_filter`, if
+    given, further restricts which stock may be handed out. Works one service and
+    one chunk at a time: each chunk locks its share of stock, writes all
+    its Replacement rows in one batch and commits, so a constant number
+    of statements is issued per chunk rather than per account. Accounts
+    left over when a service runs out of stock are returned unreplaced.
+    """
+    by_service = {}
+    for account_id, service in affected:
+        by_service.setdefault(service, []).append(account_id)
+
+    replaced, unreplaced = [], []
+    for service, account_ids in by_service.items():
+        shard = shard_for_service(service)
+        session = shard_session(shard)
+        for start in range(0, len(account_ids), BULK_REPLACEMENT_CHUNK):
+            chunk = account_ids[start:start + BULK_REPLACEMENT_CHUNK]
+            query = session.query(Account).filter(
+                Account.service == service,
+                Account.is_available == True
+            )
+            if stock_filter is not None:
+                query = query.filter(stock_filter)
+            fresh = query.order_by(Account.id).limit(len(chunk)).with_for_update(skip_locked=True).all()
+            unreplaced.extend(chunk[len(fresh):])
+            if not fresh:
+                session.rollback()
+                continue
+
+            now = datetime.utcnow()
+            pairs = list(zip(chunk, fresh))
+            session.execute(Account.__table__.update().where(
+                Account.id.in_([account.id for account in fresh])
+            ).values(is_available=False))
+            # A replaced account must not return to stock, whether its lease is still
+            # running or the sweeper released it after it was selected
+            session.execute(Account.__table__.update().where(
+                Account.id.in_([old_account_id for old_account_id, _ in pairs]),
+                db.or_(Account.lease_expires_at != None, Account.is_available == True)
+            ).values(is_available=False, lease_expires_at=None))
+            db.session.execute(Replacement.__table__.insert(), [{
+                'old_account_id': old_account_id,
+                'new_account_id': new_account.id,
+                'reason': reason,
+                'created_at': now
+            } for old_account_id, new_account in pairs])
+            bump_stats('replacement', service, now, count=len(pairs))
+            publish_inventory_event(shard, 'accounts_claimed', {'ids': [account.id for account in fresh]}, [service])
+            replaced.extend({
+                'old_account_id': old_account_id,
+                'account': serialize_account(new_account)
+            } for old_account_id, new_account in pairs)
+            commit_inventory(session, handed_out={session: [account.id for account in fresh]})
+    return replaced, unreplaced
+
+def latest_event_id(session):
+    return session.query(db.func.max(InventoryEvent.id)).scalar() or 0
+
+def latest_event_ids():
+    return {shard: latest_event_id(shard_session(shard)) for shard in inventory_shards()}
+
+def format_event_cursor(last_ids):
+    """A stream position: the last event id seen in each shard, e.g. "0:12,1:40"."""
+    return ','.join(f'{shard}:{last_id}' for shard, last_id in sorted(last_ids.items()))
+
+def parse_event_cursor(cursor):
+    """Read a position written by format_event_cursor().
+
+    A plain number is an id from before events were kept per shard and
+    belongs to the main database. Shards the cursor does not mention start
+    at their latest event.
+    """
+    last_ids = latest_event_ids()
+    if cursor.isdigit():
+        cursor = f'0:{cursor}'
+    for position in cursor.split(','):
+        shard, _, last_id = position.partition(':')
+        if shard.isdigit() and int(shard) in last_ids and last_id.isdigit():
+            last_ids[int(shard)] = int(last_id)
+    return last_ids
+
+def events_trimmed_after(session, last_id, next_id):
+    """Whether events between last_id and next_id were pruned from a shard's log.
+
+    Gaps also come from rolled-back inserts on PostgreSQL; those leave older
+    rows in place, while pruning always removes everything below the gap.
+    """
+    oldest_id = session.query(db.func.min(InventoryEvent.id)).scalar()
+    return next_id > last_id + 1 and oldest_id == next_id
+
+# Shared keep-alive session for outgoing HTTP; never reused across a fork
+http_session = None
+http_session_pid = None
+
+def get_http_session():
+    global http_session, http_session_pid
+    if http_session is None or http_session_pid != os.getpid():
+        http_session = requests.Session()
+        http_session_pid = os.getpid()
+    return http_session
+
+def reset_after_fork():
+    """Drop per-process resources inherited from a preloading parent.
+
+    Called from gunicorn's post_fork hook. The parent keeps its own
+    database connections open, so the pool is discarded without closing
+    them and each worker opens fresh ones on first use.
+    """
+    global http_session, http_session_pid
+    dispose_engines(close=False)
+    http_session = None
+    http_session_pid = None
+
+def dispose_engines(close=True):
+    with app.app_context():
+        db.engine.dispose(close=close)
+    for engine in shard_engines.values():
+        engine.dispose(close=close)
+
+def warm_templates():
+    """Compile templates up front so preloaded workers share them."""
+    for template_name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template_name)
+
 def send_telegram_notification(message):
     if TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID:
         url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
@@ -62,19 +1015,24 @@ def send_telegram_notification(message):
             "text": message
         }
         try:
-            response = requests.post(url, json=data)
+            response = get_http_session().post(url, json=data, timeout=10)
             response.raise_for_status()
         except Exception as e:
             print(f"Error sending Telegram notification: {e}")
 
 @app.route('/')
 def index():
-    accounts = Account.query.filter_by(is_available=True).all()
-    return render_template('index.html', accounts=accounts)
+    last_event_id = format_event_cursor(latest_event_ids()) if LIVE_UPDATES else ''
+    accounts = available_accounts()
+    stock = {}
+    for account in accounts:
+        stock[account.service] = stock.get(account.service, 0) + 1
+    return render_template('index.html', accounts=accounts, stock=stock, last_event_id=last_event_id,
+                           live_updates=LIVE_UPDATES)
 
 @app.route('/api/accounts', methods=['GET'])
 def get_accounts():
-    accounts = Account.query.filter_by(is_available=True).all()
+    accounts = available_accounts()
     return jsonify([{
         'id': acc.id,
         'email': acc.email,
@@ -85,20 +1043,69 @@ def get_accounts():
 
 @app.route('/api/accounts/new', methods=['GET'])
 def get_new_account():
-    # Get the first available account
-    account = Account.query.filter_by(is_available=True).first()
+    # Get the first available account, trying shards in order
+    for shard in inventory_shards():
+        session = shard_session(shard)
+        account = session.query(Account).filter_by(is_available=True).first()
+        if account:
+            break
     if account:
+        # The claim is a lease until the client confirms it; unconfirmed
+        # accounts go back to stock when the sweeper finds them expired
         account.is_available = False
-        db.session.commit()
-        return jsonify({
-            'id': account.id,
-            'email': account.email,
-            'password': account.password,
-            'service': account.service,
-            'verification_code': account.verification_code
-        })
+        account.lease_token = secrets.token_urlsafe(24)
+        account.lease_expires_at = datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)
+        publish_inventory_event(shard, 'accounts_claimed', {'ids': [account.id]}, [account.service])
+        account_data = dict(serialize_account(account), lease=serialize_lease(account))
+        commit_inventory(session)
+        return jsonify(account_data)
     return jsonify({'error': 'No accounts available'}), 404
 
+@app.route('/api/accounts/<int:account_id>/confirm', methods=['POST'])
+def confirm_account(account_id):
+    data = request.json or {}
+    lease_token = data.get('lease_token')
+    if not lease_token:
+        return jsonify({'error': 'lease_token is required'}), 400
+
+    for shard in account_shards(account_id):
+        session = shard_session(shard)
+        # Single conditional update so a confirm can never race the sweeper
+        confirmed = session.query(Account).filter(
+            Account.id == account_id,
+            Account.lease_token == lease_token,
+            Account.lease_expires_at > datetime.utcnow()
+        ).update({'lease_expires_at': None}, synchronize_session=False)
+        session.commit()
+        account = session.query(Account).get(account_id)
+        if account:
+            break
+    if not account:
+        return jsonify({'error': 'Account not found'}), 404
+    if not confirmed:
+        if account.lease_token != lease_token:
+            return jsonify({'error': 'Lease not held', 'lease': {'status': account.lease_status}}), 409
+        if account.lease_status == 'leased':
+            return jsonify({'error': 'Lease expired', 'lease': serialize_lease(account)}), 410
+    return jsonify({'message': 'Account confirmed', 'id': account.id, 'lease': serialize_lease(account)})
+
+@app.route('/api/accounts/<int:account_id>/history', methods=['GET'])
+def get_account_history(account_id):
+    if supports_recursive_cte():
+        history = account_history_recursive(account_id)
+    else:
+        history = account_history_iterative(account_id)
+    if history is None:
+        return jsonify({'error': 'Account not found'}), 404
+    return jsonify(history)
+
+@app.route('/api/accounts/<int:account_id>/lease', methods=['GET'])
+def get_account_lease(account_id):
+    account, _ = get_account(account_id)
+    if not account:
+        return jsonify({'error': 'Account not found'}), 404
+    return jsonify({'id': account.id, 'lease': {'status': account.lease_status, 'expires_at': serialize_lease(account)['expires_at']}})
+
 @app.route('/api/issues', methods=['POST'])
 def report_issue():
     data = request.json
@@ -106,17 +1113,24 @@ def report_issue():
     issue_type = data.get('issue_type')
     description = data.get('description')
 
+    # Look the account up before the insert so the issue is written in one transaction
+    account, _ = get_account(account_id)
+    if not account:
+        return jsonify({'error': 'Account not found'}), 404
+
     issue = Issue(
-        account_id=account_id,
+        account_id=account.id,
         issue_type=issue_type,
-        description=description
+        description=description,
+        created_at=datetime.utcnow()
     )
     db.session.add(issue)
+    bump_stats('issue', account.service, issue.created_at, issue_type)
+    # Built before the commit expires the loaded account
+    message = f"New Issue Reported:\nAccount: {account.email}\nService: {account.service}\nIssue Type: {issue_type}\nDescription: {description}"
     db.session.commit()
 
     # Send notification to Telegram
-    account = Account.query.get(account_id)
-    message = f"New Issue Reported:\nAccount: {account.email}\nService: {account.service}\nIssue Type: {issue_type}\nDescription: {description}"
     send_telegram_notification(message)
 
     return jsonify({'message': 'Issue reported successfully'})
@@ -127,14 +1141,17 @@ def request_replacement():
     old_account_id = data.get('account_id')
     
     # Get old account
-    old_account = Account.query.get(old_account_id)
+    old_account, old_session = get_account(old_account_id)
     if not old_account:
         return jsonify({'error': 'Account not found'}), 404
 
-    # Get new account of the same service
-    new_account = Account.query.filter_by(
-        service=old_account.service,
-        is_available=True
+    # Get new account of the same service, from the shard holding that service
+    new_shard = shard_for_service(old_account.service)
+    new_session = shard_session(new_shard)
+    new_account = new_session.query(Account).filter(
+        Account.service == old_account.service,
+        Account.is_available == True,
+        Account.id != old_account.id
     ).first()
 
     if not new_account:
@@ -142,30 +1159,129 @@ def request_replacement():
 
     # Mark new account as unavailable
     new_account.is_available = False
+    # The replaced account leaves stock for good, even if the sweeper released it
+    # after it was read; if it has since been handed to someone else it is left alone
+    old_session.query(Account).filter(
+        Account.id == old_account.id,
+        db.or_(Account.is_available == True, Account.lease_token == old_account.lease_token)
+    ).update({'is_available': False, 'lease_expires_at': None}, synchronize_session=False)
+    publish_inventory_event(new_shard, 'accounts_claimed', {'ids': [new_account.id]}, [new_account.service])
     
     # Record the replacement
     replacement = Replacement(
-        old_account_id=old_account_id,
+        old_account_id=old_account.id,
         new_account_id=new_account.id,
-        reason="Automatic replacement"
+        reason="Automatic replacement",
+        created_at=datetime.utcnow()
     )
     
     db.session.add(replacement)
-    db.session.commit()
+    bump_stats('replacement', old_account.service, replacement.created_at)
+    # Built before the commit expires both accounts
+    message = f"Account Replaced:\nOld Account: {old_account.email}\nNew Account: {new_account.email}\nService: {new_account.service}"
+    new_account_data = serialize_account(new_account)
+    commit_inventory(old_session, new_session, handed_out={new_session: [new_account.id]})
 
     # Send notification to Telegram
-    message = f"Account Replaced:\nOld Account: {old_account.email}\nNew Account: {new_account.email}\nService: {new_account.service}"
     send_telegram_notification(message)
 
     return jsonify({
         'message': 'Account replaced successfully',
-        'account': {
-            'id': new_account.id,
-            'email': new_account.email,
-            'password': new_account.password,
-            'service': new_account.service,
-            'verification_code': new_account.verification_code
-        }
+        'account': new_account_data
+    })
+
+@app.route('/api/replacements/bulk', methods=['POST'])
+def request_bulk_replacement():
+    if not admin_authorized():
+        return jsonify({'error': 'Admin token required'}), 403
+
+    data = request.json or {}
+    service = data.get('service')
+    import_batch = data.get('import_batch')
+    account_ids = data.get('account_ids')
+    if not (service or import_batch or account_ids):
+        return jsonify({'error': 'Provide service, import_batch or account_ids'}), 400
+    if account_ids is not None and not (
+        isinstance(account_ids, list) and all(isinstance(account_id, int) for account_id in account_ids)
+    ):
+        return jsonify({'error': 'account_ids must be a list of integers'}), 400
+    reason = data.get('reason') or 'Bulk replacement'
+
+    def matching(query):
+        if service:
+            query = query.filter(Account.service == service)
+        if import_batch:
+            query = query.filter(Account.import_batch == import_batch)
+        if account_ids:
+            query = query.filter(Account.id.in_(account_ids))
+        return query
+
+    shards = [shard_for_service(service)] if service else inventory_shards()
+
+    # Handed-out accounts that have not been replaced already
+    already_replaced = db.session.query(Replacement.id).filter(Replacement.old_account_id == Account.id).exists()
+    affected = []
+    for shard in shards:
+        session = shard_session(shard)
+        query = matching(session.query(Account.id, Account.service).filter(
+            Account.is_available == False,
+            Account.retired_at == None
+        ))
+        if session is db.session:
+            affected.extend(query.filter(~already_replaced).all())
+            continue
+        # Replacements live in the main database, so shard accounts are checked in batches
+        candidates = query.all()
+        for start in range(0, len(candidates), BULK_REPLACEMENT_CHUNK):
+            batch = candidates[start:start + BULK_REPLACEMENT_CHUNK]
+            replaced_ids = {old_account_id for (old_account_id,) in db.session.query(Replacement.old_account_id).filter(
+                Replacement.old_account_id.in_([account_id for account_id, _ in batch])
+            )}
+            affected.extend(candidate for candidate in batch if candidate[0] not in replaced_ids)
+    affected.sort(key=lambda candidate: (candidate[1], candidate[0]))
+
+    # Pull matching accounts still in stock so they are not handed out as replacements
+    retired, retired_sessions = [], []
+    if data.get('retire_stock'):
+        for shard in shards:
+            session = shard_session(shard)
+            shard_retired = matching(session.query(Account.id, Account.service).filter(Account.is_available == True)).all()
+            if shard_retired:
+                matching(session.query(Account).filter(Account.is_available == True)).update(
+                    {'is_available': False, 'retired_at': datetime.utcnow()}, synchronize_session=False
+                )
+                publish_inventory_event(shard, 'accounts_claimed', {'ids': [account_id for account_id, _ in shard_retired]},
+                                        {service for _, service in shard_retired})
+                retired.extend(shard_retired)
+                retired_sessions.append(session)
+    retired_ids = [account_id for account_id, _ in retired]
+    commit_inventory(*retired_sessions)
+
+    # Stock from the same bad batch or id list is never handed out as a replacement,
+    # so it must be outside both. A service-only selector (an outage) still draws on
+    # that service's stock.
+    exclusions = []
+    if import_batch:
+        exclusions.append(db.or_(Account.import_batch == None, Account.import_batch != import_batch))
+    if account_ids:
+        exclusions.append(~Account.id.in_(account_ids))
+    stock_filter = db.and_(*exclusions) if exclusions else None
+    replaced, unreplaced = replace_accounts_in_bulk(affected, reason, stock_filter)
+
+    # One summary instead of a message per account
+    selector = ', '.join(f'{key}={value}' for key, value in (
+        ('service', service), ('import_batch', import_batch),
+        ('account_ids', len(account_ids) if account_ids else None)
+    ) if value)
+    message = f"Bulk Replacement ({selector}):\nReplaced: {len(replaced)}\nNo stock available: {len(unreplaced)}\nRetired from stock: {len(retired_ids)}"
+    send_telegram_notification(message)
+
+    return jsonify({
+        'message': f'{len(replaced)} accounts replaced',
+        'replaced': len(replaced),
+        'unreplaced_account_ids': unreplaced,
+        'retired_account_ids': retired_ids,
+        'replacements': replaced
     })
 
 @app.route('/api/accounts/import', methods=['POST'])
@@ -182,26 +1298,40 @@ def import_accounts():
         stream = io.StringIO(file.stream.read().decode("UTF8"), newline=None)
         csv_reader = csv.DictReader(stream)
         
-        accounts_added = 0
+        import_batch = uuid.uuid4().hex
+        accounts_by_shard = {}
         for row in csv_reader:
             account = Account(
                 email=row['email'],
                 password=row['password'],
                 service=row['service'],
                 verification_code=row.get('verification_code'),
-                is_available=True
+                is_available=True,
+                import_batch=import_batch
             )
-            db.session.add(account)
-            accounts_added += 1
-        
-        db.session.commit()
-        return jsonify({'message': f'{accounts_added} accounts imported successfully'})
+            # Each account goes to the shard holding its service
+            shard = shard_for_service(account.service)
+            shard_session(shard).add(account)
+            accounts_by_shard.setdefault(shard, []).append(account)
+        accounts_added = sum(len(accounts) for accounts in accounts_by_shard.values())
+
+        # One event per shard, in the shard's own log
+        for shard, accounts in accounts_by_shard.items():
+            shard_session(shard).flush()
+            # Large imports only announce the count; clients refetch the listing once
+            payload = {'count': len(accounts)}
+            if len(accounts) <= EVENT_IMPORT_INLINE_LIMIT:
+                payload['accounts'] = [serialize_account(account) for account in accounts]
+            publish_inventory_event(shard, 'accounts_imported', payload, {account.service for account in accounts})
+
+        commit_inventory(*(shard_session(shard) for shard in accounts_by_shard))
+        return jsonify({'message': f'{accounts_added} accounts imported successfully', 'import_batch': import_batch})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/accounts/export', methods=['GET'])
 def export_accounts():
-    accounts = Account.query.all()
+    accounts = [account for shard in inventory_shards() for account in shard_session(shard).query(Account).all()]
     
     output = io.StringIO()
     writer = csv.writer(output)
@@ -227,9 +1357,153 @@ def export_accounts():
         download_name='accounts.csv'
     )
 
+@app.route('/api/profiles/<profile_id>', methods=['GET'])
+def get_request_profile(profile_id):
+    if not profile_authorized():
+        return jsonify({'error': 'Profile not found'}), 404
+    profile = RequestProfile.query.get(profile_id)
+    if not profile:
+        return jsonify({'error': 'Profile not found'}), 404
+    return Response(profile.report, mimetype='application/json')
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in STATS_GRANULARITIES:
+        return jsonify({'error': f"granularity must be one of {', '.join(STATS_GRANULARITIES)}"}), 400
+    try:
+        until = datetime.fromisoformat(request.args['until']) if 'until' in request.args else datetime.utcnow()
+        default_span = timedelta(hours=48) if granularity == 'hour' else timedelta(days=30)
+        since = datetime.fromisoformat(request.args['since']) if 'since' in request.args else until - default_span
+    except ValueError:
+        return jsonify({'error': 'since and until must be ISO 8601 timestamps'}), 400
+
+    # Reads only the rollup rows in range, however much raw history exists
+    query = StatsRollup.query.filter(
+        StatsRollup.granularity == granularity,
+        StatsRollup.bucket_start >= bucket_start(since, granularity),
+        StatsRollup.bucket_start <= until
+    )
+    if request.args.get('kind'):
+        query = query.filter(StatsRollup.kind == request.args['kind'])
+    if request.args.get('service'):
+        query = query.filter(StatsRollup.service == request.args['service'])
+    if request.args.get('issue_type'):
+        query = query.filter(StatsRollup.issue_type == request.args['issue_type'])
+
+    return jsonify([{
+        'kind': rollup.kind,
+        'bucket_start': rollup.bucket_start.isoformat() + 'Z',
+        'service': rollup.service,
+        'issue_type': rollup.issue_type or None,
+        'count': rollup.event_count
+    } for rollup in query.order_by(StatsRollup.bucket_start, StatsRollup.kind, StatsRollup.service).all()])
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create missing tables, columns and indexes in the main database and the shards."""
+    db.create_all()
+    upgrade_schema(db.engine, db.metadata.sorted_tables)
+    init_inventory_shards()
+    print("Database schema is up to date")
+
+@app.cli.command('rebuild-stats')
+@click.option('--since', default=None, help='ISO date to rebuild from (default: start of today, UTC)')
+def rebuild_stats_command(since):
+    """Recompute issue and replacement rollups from the raw tables."""
+    since = datetime.fromisoformat(since) if since else datetime.utcnow()
+    print(f"{rebuild_stats(since)} rollup rows written")
+
+@app.cli.command('move-to-shards')
+@click.option('--batch-size', default=1000, help='Accounts moved per transaction')
+def move_to_shards_command(batch_size):
+    """Move accounts of sharded services out of the main database, keeping their ids."""
+    table = Account.__table__
+    moved = 0
+    for service, shard in service_shards.items():
+        session = shard_session(shard)
+        while True:
+            rows = [dict(row) for row in db.session.execute(
+                table.select().where(table.c.service == service).order_by(table.c.id).limit(batch_size)
+            ).mappings()]
+            if not rows:
+                break
+            ids = [row['id'] for row in rows]
+            # Delete first so a batch interrupted between the two commits can be rerun
+            session.execute(table.delete().where(table.c.id.in_(ids)))
+            session.execute(table.insert(), rows)
+            session.commit()
+            db.session.execute(table.delete().where(table.c.id.in_(ids)))
+            db.session.commit()
+            moved += len(rows)
+    print(f"{moved} accounts moved to shards")
+
+@app.cli.command('recycle-leases')
+def recycle_leases_command():
+    """Return expired, unconfirmed claims to stock."""
+    print(f"{recycle_expired_leases()} accounts returned to stock")
+
+@app.route('/api/events', methods=['GET'])
+def inventory_events():
+    # 204 tells EventSource not to reconnect
+    if not LIVE_UPDATES:
+        return '', 204
+    slots = event_stream_slots
+    if not slots.acquire(blocking=False):
+        return '', 204
+    try:
+        # EventSource resends the last id it saw when it reconnects
+        last_ids = parse_event_cursor(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or '')
+        for shard in last_ids:
+            shard_session(shard).rollback()
+    except Exception:
+        slots.release()
+        raise
+
+    def stream(last_ids):
+        yield 'retry: 3000\n\n'
+        deadline = time.monotonic() + EVENT_STREAM_MAX_SECONDS
+        while time.monotonic() < deadline:
+            sent = False
+            # Each shard has its own log; events of different shards concern different services
+            for shard in last_ids:
+                session = shard_session(shard)
+                events = session.query(InventoryEvent).filter(
+                    InventoryEvent.id > last_ids[shard]
+                ).order_by(InventoryEvent.id).limit(100).all()
+                trimmed = bool(events) and events_trimmed_after(session, last_ids[shard], events[0].id)
+                if trimmed:
+                    last_ids[shard] = latest_event_id(session)
+                # Hand the connection back to the pool while we wait
+                session.rollback()
+                if trimmed:
+                    # The client missed events that are gone; it refetches the listing instead
+                    yield f"id: {format_event_cursor(last_ids)}\nevent: resync\ndata: {{}}\n\n"
+                    sent = True
+                    continue
+                for inventory_event in events:
+                    last_ids[shard] = inventory_event.id
+                    yield f"id: {format_event_cursor(last_ids)}\nevent: {inventory_event.event_type}\ndata: {inventory_event.payload}\n\n"
+                sent = sent or bool(events)
+            if sent:
+                continue
+            yield ': keepalive\n\n'
+            with inventory_changed:
+                inventory_changed.wait(EVENT_POLL_INTERVAL)
+
+    response = Response(
+        stream_with_context(stream(last_ids)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Runs when the client goes away or the stream ends
+    response.call_on_close(slots.release)
+    return response
+
 def create_test_account():
     # Check if test account already exists
-    if not Account.query.filter_by(email='test@example.com').first():
+    session = shard_session(shard_for_service('Netflix'))
+    if not session.query(Account).filter_by(email='test@example.com').first():
         test_account = Account(
             email='test@example.com',
             password='testpass123',
@@ -237,11 +1511,14 @@ def create_test_account():
             verification_code='123456',
             is_available=True
         )
-        db.session.add(test_account)
-        db.session.commit()
+        session.add(test_account)
+        session.commit()
 
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        upgrade_schema(db.engine, db.metadata.sorted_tables)
+        init_inventory_shards()
         create_test_account()
+    start_lease_sweeper()
     app.run(debug=True) 
\ No newline at end of file
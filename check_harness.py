@@ -0,0 +1,88 @@
+"""Shared harness for the check_*.py scripts.
+
+Usage: python check_harness.py [app_dir ...]
+
+Each check imports app.py from an app directory (default: this
+directory) against throwaway SQLite databases and drives it through the
+Flask test client, with Telegram notifications disabled. It needs no
+network or database server. load_app() imports the app under a fresh
+module name and only sets the environment while it loads, so several
+checks can run in one process. Run directly, this runs every check
+against each app directory given and exits with status 1 if any failed.
+"""
+import importlib
+import importlib.util
+import itertools
+import os
+import sys
+
+CHECKS = ['check_query_budgets', 'check_history', 'check_shards']
+
+app_module_names = (f'checked_app_{n}' for n in itertools.count())
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def check(condition, message):
+    if not condition:
+        raise CheckFailed(message)
+    print(f"ok    {message}")
+
+
+def app_dir_argument():
+    """The app directory named on the command line, or this directory."""
+    return os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(app_dir, database_path, **env):
+    """Import app.py from app_dir with its main database at database_path.
+
+    The app reads its configuration at import, so `env` is only set while
+    the module loads and the previous environment is restored afterwards.
+    """
+    saved = dict(os.environ)
+    os.environ.update(DATABASE_URL=f'sqlite:///{database_path}', TELEGRAM_BOT_TOKEN='', TELEGRAM_CHAT_ID='', **env)
+    name = next(app_module_names)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(app_dir, 'app.py'))
+    app_module = importlib.util.module_from_spec(spec)
+    # Flask finds the templates through the module registered under this name
+    sys.modules[name] = app_module
+    try:
+        spec.loader.exec_module(app_module)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+    return app_module
+
+
+def passes(check_main, app_dir):
+    """Run one check's main(app_dir); it returns False or raises CheckFailed on failure."""
+    try:
+        return check_main(app_dir) is not False
+    except CheckFailed as e:
+        print(f"FAIL: {e}")
+        return False
+
+
+def run(check_main):
+    """Command line entry point of a single check."""
+    sys.exit(0 if passes(check_main, app_dir_argument()) else 1)
+
+
+def main():
+    app_dirs = [os.path.abspath(app_dir) for app_dir in sys.argv[1:]] or [os.path.dirname(os.path.abspath(__file__))]
+    failed = []
+    for app_dir in app_dirs:
+        for name in CHECKS:
+            print(f"== {name} {app_dir}")
+            if not passes(importlib.import_module(name).main, app_dir):
+                failed.append(f'{name} {app_dir}')
+    if failed:
+        print(f"Failed: {', '.join(failed)}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Check that the per-hop history fallback matches the recursive query.
+
+Usage: python check_history.py [app_dir]
+
+Builds replacement graphs with issues: a straight chain, a branch (one
+account replaced twice, two accounts replaced by one), a cycle, and a
+chain longer than HISTORY_MAX_DEPTH. For every account in them it
+compares account_history_iterative with account_history_recursive.
+SQLite and PostgreSQL always take the recursive path, so without this
+the fallback is never exercised. Exits with status 1 on any difference.
+See check_harness.py for how the app is loaded.
+"""
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+import check_harness
+
+MAX_DEPTH = 3
+
+
+def main(app_dir):
+    app_module = check_harness.load_app(app_dir, os.path.join(tempfile.mkdtemp(), 'history.db'),
+                                        HISTORY_MAX_DEPTH=str(MAX_DEPTH))
+    app, db = app_module.app, app_module.db
+    Account, Issue, Replacement = app_module.Account, app_module.Issue, app_module.Replacement
+    started = datetime(2026, 1, 1)
+
+    with app.app_context():
+        db.create_all()
+
+        def accounts(prefix, count):
+            created = [Account(email=f'{prefix}{n}@example.com', password='p', service='Netflix',
+                               is_available=False, created_at=started) for n in range(count)]
+            db.session.add_all(created)
+            db.session.flush()
+            for n, account in enumerate(created):
+                db.session.add(Issue(account_id=account.id, issue_type='Wrong Password',
+                                     created_at=started + timedelta(minutes=n)))
+            return [account.id for account in created]
+
+        def replace(hops):
+            for n, (old, new) in enumerate(hops):
+                db.session.add(Replacement(old_account_id=old, new_account_id=new, reason='check',
+                                           created_at=started + timedelta(hours=n)))
+
+        chain = accounts('chain', 4)
+        replace(zip(chain, chain[1:]))
+        branch = accounts('branch', 5)
+        replace([(branch[0], branch[1]), (branch[0], branch[2]), (branch[3], branch[2]), (branch[2], branch[4])])
+        cycle = accounts('cycle', 3)
+        replace([(cycle[0], cycle[1]), (cycle[1], cycle[2]), (cycle[2], cycle[0])])
+        long_chain = accounts('long', MAX_DEPTH * 2 + 2)
+        replace(zip(long_chain, long_chain[1:]))
+        db.session.commit()
+
+        failed = False
+        cases = {'chain': chain, 'branch': branch, 'cycle': cycle, 'long chain': long_chain, 'missing': [10 ** 6]}
+        for name, account_ids in cases.items():
+            for account_id in account_ids:
+                recursive = app_module.account_history_recursive(account_id)
+                iterative = app_module.account_history_iterative(account_id)
+                db.session.rollback()
+                same = json.dumps(recursive, sort_keys=True) == json.dumps(iterative, sort_keys=True)
+                print(f"{'ok  ' if same else 'FAIL'}  {name}, from account {account_id}")
+                if not same:
+                    failed = True
+                    print(f"    recursive: {json.dumps(recursive, sort_keys=True)}")
+                    print(f"    iterative: {json.dumps(iterative, sort_keys=True)}")
+    return not failed
+
+
+if __name__ == '__main__':
+    check_harness.run(main)
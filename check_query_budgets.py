@@ -0,0 +1,140 @@
+"""Fail when an endpoint issues more SQL statements or transactions than budgeted.
+
+Usage: python check_query_budgets.py [app_dir]
+
+Calls each endpoint once and counts the statements and commits it
+causes. Exits with status 1 if any endpoint is over budget, or if a
+route has neither a budget nor an entry in EXEMPT, so it can run as a CI
+step. See check_harness.py for how the app is loaded.
+
+When a change legitimately needs more queries, raise the budget here in
+the same commit so the reviewer sees it.
+"""
+import io
+import os
+import tempfile
+
+import check_harness
+
+# Maximum statements / committed transactions per call, with the fixture below
+BUDGETS = {
+    'index': (2, 0),
+    'get_accounts': (1, 0),
+    'get_new_account': (5, 1),
+    'confirm_account': (2, 1),
+    'get_account_lease': (1, 0),
+    'get_account_history': (1, 0),
+    'report_issue': (3, 1),
+    # Includes the conditional update that takes the old account out of stock
+    'request_replacement': (9, 1),
+    'import_accounts': (5, 1),
+    'export_accounts': (1, 0),
+    # Affected lookup, then per chunk: stock, 2 updates, replacements, stats, event (3)
+    'request_bulk_replacement': (9, 2),
+    # One range read on the rollups, however much history exists
+    'get_stats': (1, 0),
+    'get_request_profile': (1, 0),
+}
+
+# Routes without a per-call budget, and why
+EXEMPT = {
+    'static': 'files served by Flask, no SQL',
+    'inventory_events': 'long-lived stream; it polls every EVENT_POLL_INTERVAL for as long as it is open',
+}
+
+
+class StatementCounter:
+    def __init__(self, engine, event):
+        self.statements = []
+        self.commits = 0
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+        event.listen(engine, 'commit', self.on_commit)
+
+    def on_execute(self, connection, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def on_commit(self, connection):
+        self.commits += 1
+
+    def reset(self):
+        self.statements = []
+        self.commits = 0
+
+
+def main(app_dir):
+    database_dir = tempfile.mkdtemp()
+    app_module = check_harness.load_app(app_dir, os.path.join(database_dir, 'budget.db'),
+                                        ADMIN_TOKEN='budget-check', PROFILE_TOKEN='budget-check',
+                                        PROFILE_SAMPLE_RATE='0')
+    from sqlalchemy import event
+
+    app, db = app_module.app, app_module.db
+    with app.app_context():
+        db.create_all()
+        app_module.init_inventory_shards()
+        engine = db.engine
+    counter = StatementCounter(engine, event)
+    client = app.test_client()
+
+    # Fixture: a few accounts across two services
+    client.post('/api/accounts/import', data={'file': (io.BytesIO(
+        b'email,password,service\n'
+        b'a@example.com,p,Netflix\nb@example.com,p,Netflix\nc@example.com,p,Netflix\n'
+        b'd@example.com,p,Hulu\n'
+    ), 'fixture.csv')})
+    claimed = client.get('/api/accounts/new').get_json()
+    profile_id = client.get('/api/accounts', headers={'X-Profile': 'budget-check'}).headers['X-Profile-Id']
+
+    calls = [
+        ('index', lambda: client.get('/')),
+        ('get_accounts', lambda: client.get('/api/accounts')),
+        ('get_new_account', lambda: client.get('/api/accounts/new')),
+        ('confirm_account', lambda: client.post(
+            f"/api/accounts/{claimed['id']}/confirm", json={'lease_token': claimed['lease']['token']})),
+        ('get_account_lease', lambda: client.get(f"/api/accounts/{claimed['id']}/lease")),
+        ('report_issue', lambda: client.post('/api/issues', json={
+            'account_id': claimed['id'], 'issue_type': 'Streaming Limit', 'description': 'budget check'})),
+        ('request_replacement', lambda: client.post('/api/replacements', json={'account_id': claimed['id']})),
+        ('import_accounts', lambda: client.post('/api/accounts/import', data={'file': (io.BytesIO(
+            b'email,password,service\ne@example.com,p,Netflix\nf@example.com,p,Hulu\n'
+        ), 'budget.csv')})),
+        ('export_accounts', lambda: client.get('/api/accounts/export')),
+        ('get_account_history', lambda: client.get(f"/api/accounts/{claimed['id']}/history")),
+        ('request_bulk_replacement', lambda: client.post(
+            '/api/replacements/bulk', json={'service': 'Netflix'}, headers={'X-Admin-Token': 'budget-check'})),
+        ('get_stats', lambda: client.get('/api/stats?granularity=hour&service=Netflix')),
+        ('get_request_profile', lambda: client.get(f'/api/profiles/{profile_id}', headers={'X-Profile': 'budget-check'})),
+    ]
+
+    failed = False
+    print(f"{'endpoint':<22}{'statements':>12}{'commits':>10}  result")
+    for endpoint, call in calls:
+        counter.reset()
+        response = call()
+        max_statements, max_commits = BUDGETS[endpoint]
+        over = len(counter.statements) > max_statements or counter.commits > max_commits
+        if response.status_code >= 400:
+            result = f'FAIL (HTTP {response.status_code})'
+        elif over:
+            result = f'FAIL (budget {max_statements}/{max_commits})'
+        else:
+            result = 'ok'
+        print(f"{endpoint:<22}{len(counter.statements):>12}{counter.commits:>10}  {result}")
+        if result != 'ok':
+            failed = True
+            for statement in counter.statements:
+                print(f"    {' '.join(statement.split())[:120]}")
+
+    missing = set(BUDGETS) - {endpoint for endpoint, _ in calls}
+    if missing:
+        print(f"No call defined for budgeted endpoints: {', '.join(sorted(missing))}")
+        failed = True
+    unbudgeted = {rule.endpoint for rule in app.url_map.iter_rules()} - set(BUDGETS) - set(EXEMPT)
+    if unbudgeted:
+        print(f"Routes without a budget: {', '.join(sorted(unbudgeted))} (add them to BUDGETS or EXEMPT)")
+        failed = True
+    return not failed
+
+
+if __name__ == '__main__':
+    check_harness.run(main)
@@ -0,0 +1,248 @@
+"""Check that service sharding routes inventory to the right SQLite files.
+
+Usage: python check_shards.py [app_dir]
+
+Runs with a main SQLite database and two shard files (Netflix in shard
+1, Hulu and Disney+ in shard 2) and goes through the endpoints: import,
+listings, claim and confirm, issues, replacements, bulk replacement,
+history, export, stats and the event stream. After each step the shard
+files are opened directly with sqlite3 to check where the rows ended up.
+Also moves pre-existing main database accounts with the move-to-shards
+command, and fails the main database commit of a replacement to check
+that the sweeper returns its account to stock. Foreign keys are enforced
+on every connection, as PostgreSQL would, so a constraint pointing at
+accounts in another shard fails the check. Exits with status 1 on the
+first failed check. See check_harness.py for how the app is loaded.
+"""
+import io
+import json
+import os
+import sqlite3
+import tempfile
+
+from sqlalchemy import event
+
+import check_harness
+from check_harness import check
+
+ADMIN_TOKEN = 'shard-check'
+
+
+def create_legacy_accounts(main_path):
+    """Accounts created before sharding was enabled, to exercise move-to-shards."""
+    connection = sqlite3.connect(main_path)
+    connection.execute(
+        'CREATE TABLE account (id INTEGER PRIMARY KEY, email VARCHAR(120) NOT NULL, '
+        'password VARCHAR(120) NOT NULL, service VARCHAR(50) NOT NULL, verification_code VARCHAR(10), '
+        'is_available BOOLEAN, import_batch VARCHAR(32), retired_at DATETIME, lease_token VARCHAR(64), '
+        'lease_expires_at DATETIME, created_at DATETIME)'
+    )
+    connection.executemany(
+        'INSERT INTO account (email, password, service, is_available, created_at) '
+        "VALUES (?, 'p', ?, 1, '2026-01-01 00:00:00')",
+        [('legacy-netflix@example.com', 'Netflix'), ('legacy-max@example.com', 'Max')]
+    )
+    connection.commit()
+    connection.close()
+
+
+def enforce_foreign_keys(connection, record):
+    connection.execute('PRAGMA foreign_keys = ON')
+
+
+def main(app_dir):
+    database_dir = tempfile.mkdtemp()
+    main_path = os.path.join(database_dir, 'main.db')
+    create_legacy_accounts(main_path)
+    app_module = check_harness.load_app(app_dir, main_path, ADMIN_TOKEN=ADMIN_TOKEN, INVENTORY_SHARDS=json.dumps({
+        '1': {'url': f"sqlite:///{os.path.join(database_dir, 'netflix.db')}", 'services': ['Netflix']},
+        '2': {'url': f"sqlite:///{os.path.join(database_dir, 'video.db')}", 'services': ['Hulu', 'Disney+']},
+    }))
+    app, db = app_module.app, app_module.db
+    with app.app_context():
+        # Only this app's engines; the SQLite pools open a new connection every time
+        for engine in [db.engine, *app_module.shard_engines.values()]:
+            event.listen(engine, 'connect', enforce_foreign_keys)
+        db.create_all()
+        app_module.init_inventory_shards()
+    client = app.test_client()
+
+    def rows(name, sql):
+        connection = sqlite3.connect(os.path.join(database_dir, name))
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def services(name):
+        return {service for (service,) in rows(name, 'SELECT DISTINCT service FROM account')}
+
+    def rejected(shards):
+        try:
+            app_module.check_inventory_shards(shards)
+        except ValueError:
+            return True
+        return False
+
+    check(all(rejected({shard: {'url': 'sqlite://', 'services': ['Max']}}) for shard in ('0', '22', 'video')),
+          'shard numbers outside 1..21 are rejected')
+    check(rejected({'1': {'url': 'sqlite://', 'services': ['Max']}, '2': {'url': 'sqlite://', 'services': ['Max']}}),
+          'a service in two shards is rejected')
+
+    result = app.test_cli_runner().invoke(args=['move-to-shards'])
+    check('1 accounts moved' in result.output, 'move-to-shards moves existing Netflix accounts')
+    check(services('main.db') == {'Max'} and services('netflix.db') == {'Netflix'},
+          'unsharded services stay in the main database')
+    legacy_id = rows('netflix.db', "SELECT id FROM account WHERE email = 'legacy-netflix@example.com'")[0][0]
+
+    response = client.post('/api/accounts/import', data={'file': (io.BytesIO(
+        b'email,password,service\n'
+        b'n1@example.com,p,Netflix\nn2@example.com,p,Netflix\nn3@example.com,p,Netflix\n'
+        b'h1@example.com,p,Hulu\nh2@example.com,p,Hulu\nd1@example.com,p,Disney+\n'
+        b'm1@example.com,p,Max\n'
+    ), 'accounts.csv')})
+    check(response.status_code == 200, 'import succeeds')
+    check(services('netflix.db') == {'Netflix'} and services('video.db') == {'Hulu', 'Disney+'},
+          'imported accounts land in their service shard')
+    shard_ids = [account_id for (account_id,) in rows('video.db', 'SELECT id FROM account')]
+    check(all(account_id // app_module.SHARD_ID_SPAN == 2 for account_id in shard_ids),
+          'shard 2 allocates ids from its own range')
+
+    # Counted from the files, as an app may create its own test account on import
+    stored = sum(rows(name, 'SELECT count(*) FROM account')[0][0] for name in ('main.db', 'netflix.db', 'video.db'))
+    listed = client.get('/api/accounts').get_json()
+    check(len(listed) == stored and len({account['id'] for account in listed}) == stored,
+          'listing merges all shards without duplicate ids')
+    check(b'h1@example.com' in client.get('/').data, 'index page lists shard accounts')
+
+    # Max is in shard 0, so the first claims come from the main database
+    claims = [client.get('/api/accounts/new').get_json() for _ in range(3)]
+    check([claim['service'] for claim in claims] == ['Max', 'Max', 'Netflix'],
+          'claims try shards in order')
+    netflix = claims[2]
+    check(netflix['id'] == legacy_id, 'moved account is claimable from its shard')
+    response = client.post(f"/api/accounts/{netflix['id']}/confirm", json={'lease_token': netflix['lease']['token']})
+    check(response.status_code == 200, 'confirm finds a moved account by id')
+    check(client.get(f"/api/accounts/{netflix['id']}/lease").get_json()['lease']['status'] == 'confirmed',
+          'lease status is read from the shard')
+
+    response = client.post('/api/issues', json={
+        'account_id': str(netflix['id']), 'issue_type': 'Wrong Password', 'description': 'check'})
+    check(response.status_code == 200, 'issue for a shard account is recorded')
+    check(rows('main.db', 'SELECT count(*) FROM issue')[0][0] == 1, 'issues stay in the main database')
+
+    replacement = client.post('/api/replacements', json={'account_id': netflix['id']}).get_json()
+    check('account' in replacement and replacement['account']['service'] == 'Netflix',
+          'replacement comes from the same service shard')
+    second = client.post('/api/replacements', json={'account_id': replacement['account']['id']}).get_json()
+    check('account' in second, 'replacement of a replacement')
+
+    history = client.get(f"/api/accounts/{replacement['account']['id']}/history").get_json()
+    check([account['id'] for account in history['accounts']] ==
+          [netflix['id'], replacement['account']['id'], second['account']['id']],
+          'history walks the chain across the main database and the shard')
+    check(history['accounts'][0]['email'] == 'legacy-netflix@example.com' and history['accounts'][0]['issues'],
+          'history loads shard account details and issues')
+
+    netflix_stock = rows('netflix.db', 'SELECT count(*) FROM account WHERE is_available = 1')[0][0]
+    netflix_claims = [client.get('/api/accounts/new').get_json() for _ in range(netflix_stock)]
+    check({claim['service'] for claim in netflix_claims} == {'Netflix'}, 'remaining Netflix stock is claimed before shard 2')
+    claimed_hulu = [client.get('/api/accounts/new').get_json() for _ in range(2)]
+    check({claim['service'] for claim in claimed_hulu} == {'Hulu'}, 'claims continue into shard 2')
+    response = client.post('/api/replacements/bulk', json={'service': 'Hulu', 'retire_stock': False},
+                           headers={'X-Admin-Token': ADMIN_TOKEN})
+    bulk = response.get_json()
+    check(response.status_code == 200 and bulk['replaced'] == 0 and len(bulk['unreplaced_account_ids']) == 2,
+          'bulk replacement selects handed-out accounts in the service shard')
+    response = client.post('/api/replacements/bulk', json={'service': 'Netflix'},
+                           headers={'X-Admin-Token': ADMIN_TOKEN})
+    # Netflix stock is used up, so the accounts not replaced yet are reported back
+    check(response.get_json()['unreplaced_account_ids'] == sorted([second['account']['id']] + [claim['id'] for claim in netflix_claims]),
+          'bulk replacement skips shard accounts already replaced in the main database')
+
+    export = client.get('/api/accounts/export').data.decode()
+    check(export.count('\n') == stored + 1, 'export includes accounts from every shard')
+
+    result = app.test_cli_runner().invoke(args=['rebuild-stats', '--since', '2000-01-01'])
+    check(result.exit_code == 0, 'rebuild-stats runs')
+    stats = rows('main.db', "SELECT kind, service, SUM(event_count) FROM stats_rollup "
+                            "WHERE granularity = 'day' GROUP BY kind, service")
+    check(('issue', 'Netflix', 1) in stats and ('replacement', 'Netflix', 2) in stats,
+          'rebuilt stats resolve services from the shards')
+
+    # A bad batch selected together with an id: none of the batch may be used as stock
+    check(client.get('/api/accounts/new').get_json()['service'] == 'Disney+', 'last earlier stock is claimed')
+    bad_batch = client.post('/api/accounts/import', data={'file': (io.BytesIO(
+        b'email,password,service\n'
+        b'bad1@example.com,p,Disney+\nbad2@example.com,p,Disney+\nbad3@example.com,p,Disney+\n'
+    ), 'bad.csv')}).get_json()['import_batch']
+    bad_claim = client.get('/api/accounts/new').get_json()
+    client.post('/api/accounts/import', data={'file': (io.BytesIO(
+        b'email,password,service\ngood@example.com,p,Disney+\n'
+    ), 'good.csv')})
+    response = client.post('/api/replacements/bulk', json={'import_batch': bad_batch, 'account_ids': [bad_claim['id']]},
+                           headers={'X-Admin-Token': ADMIN_TOKEN})
+    bulk = response.get_json()
+    check(response.status_code == 200 and bulk['replaced'] == 1, 'bulk replacement by batch and id')
+    check([pair['account']['email'] for pair in bulk['replacements']] == ['good@example.com'],
+          'replacement stock is outside both the batch and the id list')
+
+    # Inventory writes to a shard log their events there, not in the main database
+    client.post('/api/accounts/import', data={'file': (io.BytesIO(
+        b'email,password,service\n'
+        b'n4@example.com,p,Netflix\nn5@example.com,p,Netflix\nn6@example.com,p,Netflix\nn7@example.com,p,Netflix\n'
+    ), 'netflix.csv')})
+    main_events = rows('main.db', 'SELECT count(*) FROM inventory_event')[0][0]
+    cursor = client.get('/').data.decode().split('last_event_id=')[1].split('"')[0]
+    claim = client.get('/api/accounts/new').get_json()
+    check(claim['service'] == 'Netflix', 'claim from shard 1')
+    check(rows('main.db', 'SELECT count(*) FROM inventory_event')[0][0] == main_events,
+          'a shard claim writes no event to the main database')
+    check(rows('netflix.db', 'SELECT event_type, payload FROM inventory_event ORDER BY id DESC LIMIT 1')[0][0] == 'accounts_claimed',
+          'the claim event is in the shard')
+
+    response = client.get(f'/api/events?last_event_id={cursor}', buffered=False)
+    received = next(chunk for chunk in response.response if b'event: ' in chunk).decode()
+    response.close()
+    check(received.startswith('id: 0:') and ',1:' in received and f'"ids": [{claim["id"]}]' in received,
+          'the stream resumes from a per-shard cursor')
+
+    def stock_ids():
+        return {account_id for (account_id,) in rows('netflix.db', 'SELECT id FROM account WHERE is_available = 1')}
+
+    def lease_of(account_id):
+        return rows('netflix.db', f'SELECT is_available, lease_expires_at FROM account WHERE id = {account_id}')[0]
+
+    replacement = client.post('/api/replacements', json={'account_id': claim['id']}).get_json()
+    check(lease_of(replacement['account']['id']) == (0, None),
+          'a recorded replacement account is handed out without a lease')
+
+    # Main database commit fails after the shard committed the replacement account
+    def fail_main_commit(session):
+        raise RuntimeError('main database unavailable')
+
+    before = stock_ids()
+    event.listen(db.session, 'before_commit', fail_main_commit)
+    app.logger.disabled = True  # the expected 500 would log a traceback
+    response = client.post('/api/replacements', json={'account_id': replacement['account']['id']})
+    app.logger.disabled = False
+    event.remove(db.session, 'before_commit', fail_main_commit)
+    lost = before - stock_ids()
+    check(response.status_code == 500 and len(lost) == 1, 'replacement fails when the main commit fails')
+    lost_id = lost.pop()
+    check(lease_of(lost_id)[1] is not None, 'the unrecorded replacement account is leased')
+
+    # Expire that lease, and one on a recorded replacement as if the process stopped before clearing it
+    connection = sqlite3.connect(os.path.join(database_dir, 'netflix.db'))
+    connection.execute("UPDATE account SET lease_token = 'stale', lease_expires_at = '2000-01-01 00:00:00' "
+                       f"WHERE id IN ({lost_id}, {replacement['account']['id']})")
+    connection.commit()
+    connection.close()
+    app.test_cli_runner().invoke(args=['recycle-leases'])
+    check(lease_of(lost_id) == (1, None), 'the sweeper returns the unrecorded account to stock')
+    check(lease_of(replacement['account']['id']) == (0, None), 'the sweeper keeps a recorded replacement out of stock')
+    print('All shard checks passed')
+
+
+if __name__ == '__main__':
+    check_harness.run(main)
@@ -0,0 +1,102 @@
+"""Measure gunicorn boot time and per-worker memory with and without preload.
+
+Usage: python measure_workers.py [app_dir]
+
+Starts gunicorn from app_dir (default: this directory) using its
+gunicorn.conf.py, once with GUNICORN_PRELOAD=0 and once with
+GUNICORN_PRELOAD=1. Boot time is measured until every worker has logged
+that it is ready. RSS counts shared pages in full for every worker; PSS
+splits shared pages between the processes using them, so it shows what
+copy-on-write sharing saves. Linux only (reads /proc).
+"""
+import os
+import subprocess
+import sys
+import threading
+import time
+
+WORKERS = 4
+PORT = 10099
+
+
+def read_kb(path, field):
+    with open(path) as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+def child_pids(parent_pid):
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The ppid is the second field after the parenthesised command name
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == parent_pid:
+            pids.append(int(entry))
+    return pids
+
+
+def measure(app_dir, preload):
+    env = dict(os.environ, GUNICORN_PRELOAD='1' if preload else '0')
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '--workers', str(WORKERS), '--bind', f'127.0.0.1:{PORT}', 'app:app'],
+        cwd=app_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+
+    ready = threading.Event()
+    boot_seconds = []
+
+    def watch_log():
+        count = 0
+        for line in process.stderr:
+            if 'Worker ready' in line:
+                count += 1
+                if count == WORKERS:
+                    boot_seconds.append(time.perf_counter() - started)
+                    ready.set()
+
+    threading.Thread(target=watch_log, daemon=True).start()
+    try:
+        if not ready.wait(120):
+            raise RuntimeError('gunicorn workers did not become ready')
+        # Let any lazy per-worker setup settle before sampling
+        time.sleep(1)
+        workers = child_pids(process.pid)
+        rss = [read_kb(f'/proc/{pid}/status', 'VmRSS') for pid in workers]
+        pss = [read_kb(f'/proc/{pid}/smaps_rollup', 'Pss') for pid in workers]
+        master_pss = read_kb(f'/proc/{process.pid}/smaps_rollup', 'Pss')
+    finally:
+        process.terminate()
+        process.wait(30)
+
+    return {
+        'boot_seconds': boot_seconds[0],
+        'worker_rss_kb': sum(rss) / len(rss),
+        'worker_pss_kb': sum(pss) / len(pss),
+        'total_pss_kb': sum(pss) + master_pss,
+    }
+
+
+def main():
+    app_dir = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else os.path.dirname(__file__))
+    print(f"{'mode':<10}{'boot (s)':>10}{'worker RSS (MB)':>18}{'worker PSS (MB)':>18}{'total PSS (MB)':>17}")
+    for preload in (False, True):
+        result = measure(app_dir, preload)
+        print(f"{'preload' if preload else 'no preload':<10}"
+              f"{result['boot_seconds']:>10.2f}"
+              f"{result['worker_rss_kb'] / 1024:>18.1f}"
+              f"{result['worker_pss_kb'] / 1024:>18.1f}"
+              f"{result['total_pss_kb'] / 1024:>17.1f}")
+
+
+if __name__ == '__main__':
+    main()
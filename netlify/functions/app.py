@@ -4,6 +4,9 @@ from pathlib import Path
 import logging
 import traceback
 import json
+import io
+import base64
+import time
 
 # Configure logging
 logging.basicConfig(
@@ -21,6 +24,8 @@ sys.path.append(str(public_dir))
 # Set environment variables for Flask
 os.environ['FLASK_APP'] = str(public_dir / 'app.py')
 os.environ['TEMPLATES_AUTO_RELOAD'] = 'True'
+# Responses are buffered until the function returns, so the event stream cannot work here
+os.environ['LIVE_UPDATES'] = '0'
 
 logger.info(f"Current directory: {current_dir}")
 logger.info(f"Public directory: {public_dir}")
@@ -38,12 +43,30 @@ except Exception as e:
     logger.error(traceback.format_exc())
     raise
 
+# Credentials that must never reach the function log
+SENSITIVE_HEADERS = {'authorization', 'cookie', 'x-admin-token', 'x-profile'}
+
+def redact_headers(headers):
+    return {key: '[redacted]' if key.lower() in SENSITIVE_HEADERS else value
+            for key, value in (headers or {}).items()}
+
+def redact_event(event):
+    redacted = dict(event, headers=redact_headers(event.get('headers')))
+    if event.get('multiValueHeaders'):
+        redacted['multiValueHeaders'] = redact_headers(event['multiValueHeaders'])
+    return redacted
+
+def redact_environ(environ):
+    return {key: '[redacted]' if key.startswith('HTTP_') and key[5:].lower().replace('_', '-') in SENSITIVE_HEADERS
+            else value for key, value in environ.items()}
+
 def handler(event, context):
     """Handle incoming requests."""
     try:
+        started = time.perf_counter()
         # Log the full event for debugging
         logger.info("Received new request")
-        logger.debug(f"Full event: {json.dumps(event, indent=2)}")
+        logger.debug(f"Full event: {json.dumps(redact_event(event), indent=2)}")
         
         # Parse request
         path = event.get('path', '/')
@@ -51,9 +74,13 @@ def handler(event, context):
         headers = event.get('headers', {})
         query_string = event.get('queryStringParameters', {})
         body = event.get('body', '')
+        if event.get('isBase64Encoded') and body:
+            body_bytes = base64.b64decode(body)
+        else:
+            body_bytes = body.encode('utf-8') if body else b''
 
         logger.info(f"Processing {http_method} request to {path}")
-        logger.debug(f"Headers: {json.dumps(headers, indent=2)}")
+        logger.debug(f"Headers: {json.dumps(redact_headers(headers), indent=2)}")
         logger.debug(f"Query parameters: {json.dumps(query_string, indent=2)}")
         
         if body:
@@ -66,13 +93,13 @@ def handler(event, context):
             'PATH_INFO': path,
             'QUERY_STRING': '&'.join(f"{k}={v}" for k, v in query_string.items()) if query_string else '',
             'CONTENT_TYPE': headers.get('content-type', ''),
-            'CONTENT_LENGTH': headers.get('content-length', ''),
+            'CONTENT_LENGTH': str(len(body_bytes)),
             'SERVER_NAME': 'netlify',
             'SERVER_PORT': '443',
             'SERVER_PROTOCOL': 'HTTP/1.1',
             'wsgi.version': (1, 0),
             'wsgi.url_scheme': 'https',
-            'wsgi.input': body.encode('utf-8') if body else b'',
+            'wsgi.input': io.BytesIO(body_bytes),
             'wsgi.errors': sys.stderr,
             'wsgi.multithread': False,
             'wsgi.multiprocess': False,
@@ -92,7 +119,7 @@ def handler(event, context):
             if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
                 environ[f'HTTP_{key}'] = value
 
-        logger.debug(f"Created WSGI environment: {json.dumps(environ, indent=2)}")
+        logger.debug(f"Created WSGI environment: {json.dumps(redact_environ(environ), indent=2, default=str)}")
 
         # Create response object
         response = {}
@@ -106,15 +133,25 @@ def handler(event, context):
         try:
             # Get response from Flask app
             logger.info("Calling Flask application")
-            response_body = app(environ, start_response)
+            app_iter = app(environ, start_response)
             
             # Convert response body to string
-            if isinstance(response_body, (list, tuple)):
-                response_body = b''.join(response_body)
+            try:
+                response_body = b''.join(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
             if isinstance(response_body, bytes):
                 response_body = response_body.decode('utf-8')
             
             response['body'] = response_body
+
+            # Profiled requests also report the time spent in this adapter
+            profile_id = response['headers'].get('X-Profile-Id')
+            if profile_id:
+                handler_ms = (time.perf_counter() - started) * 1000
+                response['headers']['Server-Timing'] += f', handler;dur={handler_ms:.1f}'
+                logger.info(f"Request profile {profile_id} stored, handler time {handler_ms:.1f}ms")
             logger.info(f"Response generated successfully, body length: {len(response_body)}")
             logger.debug(f"Response body preview: {response_body[:200]}...")
             
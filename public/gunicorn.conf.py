@@ -1,3 +1,50 @@
+import gc
+import os
+import sys
+
 workers = 4
+# Threaded workers so long-lived /api/events streams do not block a whole worker.
+# Streams are capped per worker (see post_worker_init) so they cannot take every thread.
+worker_class = "gthread"
+threads = 8
 bind = "0.0.0.0:10000"
-timeout = 120 
\ No newline at end of file
+timeout = 120
+
+# Import the app once in the master and fork workers from it, so code,
+# compiled templates and config are shared copy-on-write.
+# Set GUNICORN_PRELOAD=0 to import the app separately in every worker.
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+# Recycle workers to bound slow memory growth; with preload a replacement
+# worker is a cheap fork of the master rather than a fresh import.
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "100"))
+
+
+def when_ready(server):
+    app_module = sys.modules.get("app")
+    if app_module is not None:
+        app_module.warm_templates()
+        # Workers must not inherit the master's database connections
+        app_module.dispose_engines()
+
+
+def pre_fork(server, worker):
+    # Keep the garbage collector from touching (and so copying) shared pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    app_module = sys.modules.get("app")
+    if app_module is not None:
+        app_module.reset_after_fork()
+
+
+def post_worker_init(worker):
+    # Each worker sweeps expired claim leases; the sweep skips rows another worker holds
+    from app import start_lease_sweeper, limit_event_streams
+    start_lease_sweeper()
+    # Keep at least half of each worker's threads for claims, imports and replacements
+    if "EVENT_STREAMS_PER_WORKER" not in os.environ:
+        limit_event_streams(max(1, worker.cfg.threads // 2))
+    worker.log.info("Worker ready (pid: %s)", worker.pid)